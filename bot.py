@@ -9,232 +9,337 @@ Version: 1.2.0
 import os
 import logging
 import discord
-import requests
+import aiohttp
+import orjson
 from discord.ext import tasks, commands
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
+from typing import Optional
+import functools
 import gc
+import hashlib
+import random
 import sys
+import time
 import asyncio
 from discord.errors import HTTPException, NotFound, Forbidden
-from requests.exceptions import RequestException
-import time
 
-async def delete_all_messages(channel):
+try:
+    import uvloop  # Faster drop-in event loop, not available on Windows
+except ImportError:
+    uvloop = None
+
+async def delete_all_messages(channel, expected=0):
     try:
-        async for message in channel.history(limit=100):
-            try:
-                await message.delete()
-            except discord.Forbidden:
-                logging.error("Bot does not have permission to delete messages.")
-            except discord.errors.NotFound:
-                logging.warning(f"Message with ID {message.id} not found when attempting to delete.")
+        # Bulk delete removes up to 100 messages per API call, messages older than 14 days
+        # can't be bulk deleted so purge falls back to deleting those one by one.
+        # The channel usually only holds the bot's few messages, so look at a small page first and 100 if it was full
+        limit = max(expected + 2, 10)
+        deleted = await channel.purge(limit=limit, bulk=True)
+        if len(deleted) >= limit:
+            await channel.purge(limit=100, bulk=True)
+    except discord.Forbidden:
+        logging.error("Bot does not have permission to delete messages, only its own messages will be deleted.")
+        try:
+            # Deleting its own messages doesn't need the Manage Messages permission, but has to be done one by one
+            await channel.purge(limit=100, bulk=False, check=lambda message: message.author == channel.guild.me)
+        except discord.errors.DiscordException as e:
+            logging.error(f"Failed to delete the bot's own messages in channel {channel.id}: {e}")
     except discord.errors.DiscordException as e:
         logging.error(f"Failed to delete messages in channel {channel.id}: {e}")
 
-def format_progress_bar(size, sizeleft, bar_length=20):
-    try:
-        size = int(size)
-        sizeleft = int(sizeleft)
-        progress = size - sizeleft
-        percentage = (progress / size) * 100
-        filled_length = int(bar_length * progress // size)
-        bar = '█' * filled_length + '-' * (bar_length - filled_length)
-        return f"[{bar}] {percentage:.1f}%"
-    except (ValueError, ZeroDivisionError):
+# Every possible progress bar, indexed by the number of filled segments
+_BAR_LEN = 20
+_BARS = tuple('█' * i + '-' * (_BAR_LEN - i) for i in range(_BAR_LEN + 1))
+
+def format_progress_bar(size, sizeleft):
+    # size and sizeleft are byte counts as ints, a size of 0 means the Arr instance doesn't know it yet
+    if size <= 0:
         return "Progress unavailable"
+    progress = size - sizeleft
+    percentage = progress * 100.0 / size
+    filled_length = min(max(_BAR_LEN * progress // size, 0), _BAR_LEN)
+    return f"[{_BARS[filled_length]}] {percentage:.1f}%"
 
 
-def calculate_speed(size_left_gb, time_left_minutes):
-    if time_left_minutes <= 0:
-        return "N/A"
-    # Convert size from GB to MB (1 GB = 1024 MB)
-    size_left_mb = size_left_gb * 1024
-    # Convert time from minutes to seconds
-    time_left_seconds = time_left_minutes * 60
-    # Calculate speed in MB/s
-    speed_mb_per_sec = size_left_mb / time_left_seconds
-    # Format speed to MB/s
-    return f"{speed_mb_per_sec:.2f} MB/s"
-
-def query_sonarr(ip, port, api_key, app_title, max_retries=5, delay=10):
-    headers = {"X-Api-Key": api_key}
-    endpoint = f"http://{ip}:{port}/api/v3/queue/details?includeSeries=true&includeEpisode=true"
+_MB = 1 << 20  # Bytes in a MB (1024 * 1024)
 
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = requests.get(endpoint, headers=headers, timeout=10)
-            response.raise_for_status()  # Raise an error for bad status codes
-            json_data = response.json()
-            break  # Exit the loop if the request is successful
-        except RequestException as e:
-            logging.error(f"An error occurred when querying Sonarr {app_title}: {e}")
-            retries += 1
-            if retries < max_retries:
-                logging.info(f"Retrying in {delay} seconds... ({retries}/{max_retries})")
-                time.sleep(delay)
-            else:
-                logging.error(f"Max retries exceeded. Failed to connect to Sonarr at {ip}:{port}.")
-                return []  # Return an empty list to avoid further errors
-
-    embeds = []
-    for item in json_data:
-        # Extract fields from the main data
-        main_title = item.get("title")
-        status = item.get("status")
-        timeleft = item.get("timeleft", "N/A")
-        size = item.get("size", "N/A")
-        sizeleft = item.get("sizeleft", "N/A")
-        sizeleft_gb = item.get("sizeleft", 0) / (1024 ** 3)  # Convert bytes to GB
-        error_message = item.get("errorMessage", None)
-
-        # Extract and format estimatedCompletionTime
-        estimatedCompletionTime = item.get("estimatedCompletionTime", "N/A")
-        try:
-            est_time = datetime.fromisoformat(estimatedCompletionTime.replace("Z", "+00:00"))
-            formatted_time = est_time.strftime("%d.%m.%Y %H:%M:%S")
-        except ValueError:
-            formatted_time = estimatedCompletionTime
-
-        # Create the progress bar
-        progress_bar = format_progress_bar(size, sizeleft)
+def calculate_speed(size_left_bytes, time_left_seconds):
+    if time_left_seconds <= 0:
+        return "N/A"
+    # Calculate speed in MB/s straight from the bytes and seconds the Arr instance reports
+    return f"{size_left_bytes / (time_left_seconds * _MB):.2f} MB/s"
+
+@functools.lru_cache(maxsize=512)  # The same downloads report the same ETA tick after tick
+def format_eta(eta):
+    # Arr instances send fixed-layout timestamps like '2024-01-02T15:04:05.123Z', so slice them directly
+    if len(eta) >= 19 and eta[4] == '-' and eta[7] == '-' and eta[10] == 'T' and eta[13] == ':' and eta[16] == ':':
+        return f"{eta[8:10]}.{eta[5:7]}.{eta[0:4]} {eta[11:13]}:{eta[14:16]}:{eta[17:19]}"
+    try:
+        est_time = datetime.fromisoformat(eta.replace("Z", "+00:00"))
+        return est_time.strftime("%d.%m.%Y %H:%M:%S")
+    except ValueError:
+        return eta
+
+def timeleft_to_seconds(timeleft):
+    # Parse an Arr "[d.]hh:mm:ss[.fffffff]" timeleft without building intermediate lists, 0 for "N/A" or invalid formats
+    if not timeleft or ':' not in timeleft:
+        return 0
+    hours, _, rest = timeleft.partition(':')
+    minutes, _, seconds = rest.partition(':')
+    days, _, hours = hours.rpartition('.')  # Timeleft of a day or more is prefixed with the number of days
+    try:
+        return ((int(days or 0) * 24 + int(hours)) * 60 + int(minutes)) * 60 + float(seconds)
+    except ValueError:
+        return 0  # Default to 0 if parsing fails
+
+def get_poster_url(instance, media):
+    # Posters don't change while a download is queued, so the image list of each series/movie is only scanned once
+    media_id = media.get("id")
+    cache_key = (instance, media_id)
+    if cache_key in poster_cache:
+        return poster_cache[cache_key]
+    webimage = next((image.get("remoteUrl") for image in media.get("images", []) if image.get("coverType") == "poster"), None)
+    if media_id is not None:  # Items without an ID can't be told apart, so they're never cached
+        poster_cache[cache_key] = webimage
+    return webimage
+
+@dataclass(frozen=True, slots=True)
+class DownloadRow:
+    # Everything shown in the embed of a single queued download, so rows can be compared (and hashed) between ticks
+    app_title: str
+    colour: int
+    title: str
+    status: str
+    timeleft: str
+    completion: str
+    progress: str
+    speed: str
+    poster: Optional[str]
+    error: Optional[str]
+    episode: Optional[tuple] = None  # (episode title, season number, episode number), Sonarr only
+
+@dataclass
+class BotState:
+    # Messages shown in the channel and polling state, shared by on_ready, update_messages and /refresh
+    bot_messages: dict = field(default_factory=dict)  # batch ID -> message, its rows and embeds
+    default_message: Optional[discord.Message] = None
+    shown_rows: Optional[list] = None  # Every row the channel fully shows, None if it may be out of date
+    empty_streak: int = 0  # Number of consecutive polls that found nothing downloading
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+def build_embed(row, timestamp):
+    # Build the embed's payload as one dict and hand it to Embed.from_dict, instead of a method call per field
+    fields = []
+    if row.episode is not None:
+        episode_title, season_number, episode_number = row.episode
+        fields += [
+            ("Episode Title", episode_title, True),
+            ("Season Number", season_number, True),
+            ("Episode Number", episode_number, True),
+        ]
+    fields += [
+        ("Time Left", row.timeleft, True),
+        ("Estimated Completion Time", row.completion, True),
+        ("Status", row.status, True),
+        ("Progress", row.progress, False),
+        ("Download Speed", row.speed, False),
+    ]
+    if row.error:
+        fields.append(("Error message", row.error, False))
+    data = {
+        "type": "rich",
+        "title": row.title,
+        "color": row.colour,
+        "author": {"name": row.app_title},
+        # Discord expects strings, like add_field() would have made of them
+        "fields": [{"name": name, "value": str(value), "inline": inline} for name, value, inline in fields],
+    }
+    if row.poster:
+        data["thumbnail"] = {"url": row.poster}
+    embed = discord.Embed.from_dict(data)
+    embed.timestamp = timestamp  # Set directly, from_dict would parse it back from an ISO string
+    return embed
+
+def build_row(item, *, instance, app_title, colour, media_key, include_episode=False):
+    # Shared Sonarr & Radarr queue item processing, media_key is the nested "series" or "movie" object
+    get = item.get  # Bound once, every field below is read through it
 
-        # Convert timeleft to minutes safely
-        if timeleft != "N/A" and ':' in timeleft:
-            try:
-                time_parts = [int(part) for part in timeleft.split(':')]
-                time_left_minutes = time_parts[0] * 60 + time_parts[1] + (time_parts[2] / 60)
-            except (ValueError, IndexError):
-                time_left_minutes = 0  # Default to 0 if parsing fails
+    # Extract fields from the main data
+    main_title = get("title")
+    status = get("status")
+    timeleft = get("timeleft", "N/A")
+    size = int(get("size") or 0)  # Bytes, the Arr instances send them as numbers that may be floats or null
+    sizeleft = int(get("sizeleft") or 0)
+    error_message = get("errorMessage", None)
+
+    # Extract and format estimatedCompletionTime
+    estimatedCompletionTime = get("estimatedCompletionTime") or "N/A"  # Also covers an explicit null
+    formatted_time = format_eta(estimatedCompletionTime)
+
+    # Create the progress bar
+    progress_bar = format_progress_bar(size, sizeleft)
+
+    # Calculate download speed from the bytes and seconds left, "N/A" if the time left is unknown
+    download_speed = calculate_speed(sizeleft, timeleft_to_seconds(timeleft))
+
+    # Extract the poster from the nested "series"/"movie" object
+    webimage = get_poster_url(instance, get(media_key, {}))
+
+    # Extract fields from the nested "episode" object (Sonarr only)
+    episode_info = None
+    if include_episode:
+        episode = get("episode", {})
+        episode_info = (episode.get("title"), episode.get("seasonNumber"), episode.get("episodeNumber"))
+
+    return DownloadRow(app_title=app_title,
+                       colour=colour,
+                       title=main_title,
+                       status=status,
+                       timeleft=timeleft,
+                       completion=formatted_time,
+                       progress=progress_bar,
+                       speed=download_speed,
+                       poster=webimage,
+                       error=error_message,
+                       episode=episode_info)
+
+def build_rows(json_data, signature, **kwargs):
+    # Reuse the row of every queue item whose displayed fields are unchanged since the last build, by queue item ID
+    instance = kwargs["instance"]
+    cached_rows = row_cache.get(instance, {})
+    new_cache = {}
+    rows = []
+    for item, item_signature in zip(json_data, signature):
+        item_id = item.get("id")
+        cached = cached_rows.get(item_id)
+        if cached is not None and cached[0] == item_signature:
+            row = cached[1]
         else:
-            time_left_minutes = 0  # Default to 0 for "N/A" or invalid formats
-
-        # Calculate download speed if time_left_minutes > 0
-        download_speed = calculate_speed(sizeleft_gb, time_left_minutes) if time_left_minutes > 0 else "N/A"
-
-        # Extract fields from the nested "series" object
-        series = item.get("series", {})
-        images = series.get("images", [])
-        webimage = None
-        for image in images:
-            if image.get("coverType") == "poster":
-                webimage = image.get("remoteUrl")
-                break
-
-        # Extract fields from the nested "episode" object
-        episode = item.get("episode", {})
-        episode_title = episode.get("title")
-        season_number = episode.get("seasonNumber")
-        episode_number = episode.get("episodeNumber")
-
-        # Create an embed
-        embed = discord.Embed(title=main_title,
-                              colour=0x00b0f4,
-                              timestamp=datetime.now(timezone.utc))
-        embed.set_author(name=app_title)
-        embed.add_field(name="Episode Title", value=episode_title, inline=True)
-        embed.add_field(name="Season Number", value=season_number, inline=True)
-        embed.add_field(name="Episode Number", value=episode_number, inline=True)
-        embed.add_field(name="Time Left", value=timeleft, inline=True)
-        embed.add_field(name="Estimated Completion Time", value=formatted_time, inline=True)
-        embed.add_field(name="Status", value=status, inline=True)
-        embed.add_field(name="Progress", value=progress_bar, inline=False)
-        embed.add_field(name="Download Speed", value=download_speed, inline=False)
-        if error_message:
-            embed.add_field(name="Error message", value=error_message, inline=False)
-        if webimage:
-            embed.set_thumbnail(url=webimage)
-
-        embeds.append(embed)
-    return embeds
-
-def query_radarr(ip, port, api_key, app_title, max_retries=5, delay=10):
-    headers = {"X-Api-Key": api_key}
-    endpoint = f"http://{ip}:{port}/api/v3/queue/details?includeMovie=true"
+            row = build_row(item, **kwargs)
+        if item_id is not None:  # Items without an ID can't be told apart, so they're never cached
+            new_cache[item_id] = (item_signature, row)
+        rows.append(row)
+    row_cache[instance] = new_cache  # Only keeps items still in the queue
+    return rows
+
+# Fields of a queue item that its DownloadRow is built from, the poster is cached per series/movie ID
+SIGNATURE_FIELDS = ("id", "episodeId", "seriesId", "movieId", "title", "status", "size", "sizeleft", "timeleft",
+                    "estimatedCompletionTime", "errorMessage")
+EPISODE_SIGNATURE_FIELDS = ("title", "seasonNumber", "episodeNumber")  # Displayed fields of the nested episode
+
+def item_signature(item):
+    get = item.get
+    episode = get("episode") or {}
+    return (*(get(key) for key in SIGNATURE_FIELDS), *(episode.get(key) for key in EPISODE_SIGNATURE_FIELDS))
+
+def queue_signature(json_data):
+    return tuple(item_signature(item) for item in json_data)
+
+# Settings that differ between Sonarr and Radarr queues
+ARR_KINDS = {
+    "sonarr": {"name": "Sonarr", "query": "includeSeries=true&includeEpisode=true",
+               "colour": 0x00b0f4, "media_key": "series", "include_episode": True},
+    "radarr": {"name": "Radarr", "query": "includeMovie=true",
+               "colour": 0xbd5b00, "media_key": "movie", "include_episode": False},
+}
+
+def retry_delay(error, retries, delay, max_delay=60):
+    # Honour the Retry-After of a 429 response, otherwise back off exponentially with jitter so a recovering
+    # Arr instance isn't hit by every retry at the same moment
+    if isinstance(error, aiohttp.ClientResponseError) and error.status == 429 and error.headers:
+        retry_after = error.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(int(retry_after), max_delay)
+    return min(delay * 2 ** (retries - 1), max_delay) + random.uniform(0, delay)
+
+@dataclass(frozen=True, slots=True)
+class ArrQuery:
+    # Everything needed to poll one Arr instance, worked out once at startup instead of on every tick
+    kind: str
+    app_title: str
+    address: str  # ip:port, for log messages
+    endpoint: str
+    headers: dict = field(repr=False)  # Holds the API key, so it's kept out of logs
+
+def make_query(kind, ip, port, api_key, app_title):
+    endpoint = f"http://{ip}:{port}/api/v3/queue/details?{ARR_KINDS[kind]['query']}"
+    return ArrQuery(kind, app_title, f"{ip}:{port}", endpoint, {"X-Api-Key": api_key})
+
+async def query_arr(session, query, max_retries=5, delay=2):
+    arr = ARR_KINDS[query.kind]
+    name = arr["name"]
+    app_title = query.app_title
+    key = query.endpoint  # Caches are kept per instance, titles can be shared or left empty
+
+    # Serve the rows from memory while they are younger than CACHE_TTL seconds
+    if time.monotonic() < cache_expiry.get(key, 0):
+        return last_rows[key]
+
+    headers = query.headers
+    # Only ask for the queue body if it changed since the last response that carried an ETag or Last-Modified
+    if last_validators.get(key):
+        headers = {**headers, **last_validators[key]}
+    endpoint = query.endpoint
 
     retries = 0
     while retries < max_retries:
         try:
-            response = requests.get(endpoint, headers=headers, timeout=10)
-            response.raise_for_status()  # Raise an error for bad status codes
-            json_data = response.json()
+            async with session.get(endpoint, headers=headers) as response:
+                response.raise_for_status()  # Raise an error for bad status codes
+                if response.status == 304:  # Not Modified, the queue is the same as last time
+                    cache_expiry[key] = time.monotonic() + CACHE_TTL
+                    return last_rows[key]
+                body = await response.read()
+                validators = {}
+                if "ETag" in response.headers:
+                    validators["If-None-Match"] = response.headers["ETag"]
+                if "Last-Modified" in response.headers:
+                    validators["If-Modified-Since"] = response.headers["Last-Modified"]
             break  # Exit the loop if the request is successful
-        except RequestException as e:
-            logging.error(f"An error occurred when querying Radarr {app_title}: {e}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"An error occurred when querying {name} {app_title}: {e}")
             retries += 1
             if retries < max_retries:
-                logging.info(f"Retrying in {delay} seconds... ({retries}/{max_retries})")
-                time.sleep(delay)
+                wait = retry_delay(e, retries, delay)
+                logging.info(f"Retrying in {wait:.1f} seconds... ({retries}/{max_retries})")
+                await asyncio.sleep(wait)
             else:
-                logging.error(f"Max retries exceeded. Failed to connect to Radarr at {ip}:{port}.")
+                logging.error(f"Max retries exceeded. Failed to connect to {name} at {query.address}.")
                 return []  # Return an empty list to avoid further errors
 
-    embeds = []
-    # Extract fields from the main data
-    for item in json_data:
-        main_title = item.get("title")
-        status = item.get("status")
-        timeleft = item.get("timeleft", "N/A")
-        size = item.get("size", "N/A")
-        sizeleft = item.get("sizeleft", "N/A")
-        sizeleft_gb = item.get("sizeleft", 0) / (1024 ** 3)  # Convert bytes to GB
-        error_message = item.get("errorMessage", None)
-
-        # Extract and format estimatedCompletionTime
-        estimatedCompletionTime = item.get("estimatedCompletionTime", "N/A")
+    # Reuse the previous rows if the queue hasn't changed since the last tick
+    body_hash = hashlib.blake2b(body, digest_size=16).digest()
+    if body_hash == last_hashes.get(key):
+        rows = last_rows[key]
+    else:
         try:
-            est_time = datetime.fromisoformat(estimatedCompletionTime.replace("Z", "+00:00"))
-            formatted_time = est_time.strftime("%d.%m.%Y %H:%M:%S")
-        except ValueError:
-            formatted_time = estimatedCompletionTime
+            json_data = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            logging.error(f"Received an invalid response from {name} {app_title}: {e}")
+            return []  # Return an empty list to avoid further errors
+
+        # The body also changes when fields that aren't displayed do, so only rebuild if a displayed one changed
+        signature = queue_signature(json_data)
+        if signature == last_signatures.get(key):
+            rows = last_rows[key]
+        else:
+            rows = build_rows(json_data, signature, instance=key, app_title=app_title, colour=arr["colour"],
+                              media_key=arr["media_key"], include_episode=arr["include_episode"])
+        last_hashes[key] = body_hash
+        last_signatures[key] = signature
+        last_rows[key] = rows
 
-        # Create the progress bar
-        progress_bar = format_progress_bar(size, sizeleft)
+    cache_expiry[key] = time.monotonic() + CACHE_TTL
 
-        # Convert timeleft to minutes safely
-        if timeleft != "N/A" and ':' in timeleft:
-            try:
-                time_parts = [int(part) for part in timeleft.split(':')]
-                time_left_minutes = time_parts[0] * 60 + time_parts[1] + (time_parts[2] / 60)
-            except (ValueError, IndexError):
-                time_left_minutes = 0  # Default to 0 if parsing fails
-        else:
-            time_left_minutes = 0  # Default to 0 for "N/A" or invalid formats
-
-        # Calculate download speed if time_left_minutes > 0
-        download_speed = calculate_speed(sizeleft_gb, time_left_minutes) if time_left_minutes > 0 else "N/A"
-
-        # Extract fields from the nested "movie" object
-        movie = item.get("movie", {})
-        images = movie.get("images", [])
-        webimage = None
-        for image in images:
-            if image.get("coverType") == "poster":
-                webimage = image.get("remoteUrl")
-                break
-
-        # Create an embed
-        embed = discord.Embed(title=main_title,
-                              colour=0xbd5b00,
-                              timestamp=datetime.now(timezone.utc))
-        embed.set_author(name=app_title)
-        embed.add_field(name="Time Left", value=timeleft, inline=True)
-        embed.add_field(name="Estimated Completion Time", value=formatted_time, inline=True)
-        embed.add_field(name="Status", value=status, inline=True)
-        embed.add_field(name="Progress", value=progress_bar, inline=False)
-        embed.add_field(name="Download Speed", value=download_speed, inline=False)
-        if error_message:
-            embed.add_field(name="Error message", value=error_message, inline=False)
-        if webimage:
-            embed.set_thumbnail(url=webimage)
-
-        embeds.append(embed)
-    return embeds
-
-def split_embeds(embeds, max_embeds=10):
-    # Split embeds into chunks of max_embeds each
-    return [embeds[i:i + max_embeds] for i in range(0, len(embeds), max_embeds)]
+    # Remember the validators of the queue these rows were built from
+    last_validators[key] = validators
+    return rows
+
+def split_embeds(rows, max_embeds=10):
+    # Split downloads into chunks of max_embeds each, Discord allows up to 10 embeds in a single message
+    return [rows[i:i + max_embeds] for i in range(0, len(rows), max_embeds)]
 
 async def send_default_message(channel):
     # Send a default message indicating nothing is being downloaded
@@ -242,79 +347,154 @@ async def send_default_message(channel):
     return default_message
 
 
-async def handle_messages(channel, embeds, default_message=None):
-    global bot_messages  # Dictionary to store active messages
+async def gather_limited(coros, limit=5):
+    # Run Discord API calls concurrently, but never more than `limit` at once to stay clear of the global rate limit
+    semaphore = asyncio.Semaphore(limit)
 
-    # If no active downloads and no embeds to show
-    if not embeds:
-        # Delete all existing download messages
-        for message_id, msg_info in list(bot_messages.items()):
-            try:
-                await msg_info['message'].delete()
-                del bot_messages[message_id]
-            except discord.errors.NotFound:
-                logging.warning(f"Message with ID {message_id} not found when attempting to delete.")
+    async def run(coro):
+        async with semaphore:
+            return await coro
 
-        # Display default message if it's not already displayed
-        if not default_message:  # Only create the default message if it doesn't exist
-            default_message = await channel.send("No active downloads currently.")
-        return default_message  # Return the default message for future reference
+    return await asyncio.gather(*(run(coro) for coro in coros), return_exceptions=True)
 
-    # If there are embeds (i.e., active downloads)
-    # Delete the default message if it's currently displayed
-    if default_message:
+async def delete_batches(channel, bot_messages, batch_ids):
+    # Delete the messages of the given batches and forget them
+    if len(batch_ids) > 1:
+        # One bulk-delete call instead of one call per message
         try:
-            await default_message.delete()
-            default_message = None  # Set to None after deleting
-        except discord.errors.NotFound:
-            logging.warning(f"Default message with ID {default_message.id} not found when attempting to delete.")
-
-    # Mark all existing messages as "inactive" initially
-    for message_id in list(bot_messages.keys()):
-        bot_messages[message_id]['active'] = False
-
-    # Batch embeds into groups of up to 10 (Discord's limit)
-    batched_embeds = [embeds[i:i + 10] for i in range(0, len(embeds), 10)]
-
-    # Update or create new messages for active downloads
-    for i, embed_batch in enumerate(batched_embeds):
-        batch_id = f'batch_{i}'  # Unique ID for each batch of embeds
-
-        if batch_id in bot_messages:
-            # If the message exists, update the embed batch
-            msg = bot_messages[batch_id]['message']
+            await channel.delete_messages([bot_messages[batch_id]['message'] for batch_id in batch_ids])
+            for batch_id in batch_ids:
+                del bot_messages[batch_id]
+            return
+        except discord.errors.HTTPException as e:
+            logging.warning(f"Bulk delete failed, deleting the messages one by one instead: {e}")
+
+    results = await gather_limited(bot_messages[batch_id]['message'].delete() for batch_id in batch_ids)
+    for batch_id, result in zip(batch_ids, results):
+        if isinstance(result, discord.errors.NotFound):
+            logging.warning(f"Message for batch {batch_id} not found when attempting to delete.")
+        elif isinstance(result, BaseException):
+            logging.error(f"Failed to delete message for batch {batch_id}: {result}")
+            continue  # Keep it so the delete is retried on the next tick
+        del bot_messages[batch_id]
+
+async def reset_channel(channel, state):
+    # Remove the bot's messages so everything is posted again from scratch, the caller holds state.lock
+    if state.bot_messages or state.default_message:
+        # The bot knows which messages it posted, so delete those directly instead of scanning the channel history
+        await delete_batches(channel, state.bot_messages, list(state.bot_messages))
+        if state.default_message:
             try:
-                await msg.edit(embeds=embed_batch)
-                bot_messages[batch_id]['active'] = True  # Mark the message as active
+                await state.default_message.delete()
             except discord.errors.NotFound:
-                logging.warning(f"Message for batch {batch_id} not found. Creating a new one.")
-                new_msg = await channel.send(embeds=embed_batch)
-                bot_messages[batch_id] = {'message': new_msg, 'active': True}
-        else:
-            # If the message doesn't exist, create a new one
-            new_msg = await channel.send(embeds=embed_batch)
-            bot_messages[batch_id] = {'message': new_msg, 'active': True}
-
-    # Delete messages for downloads that are no longer active
-    for download_id, msg_info in list(bot_messages.items()):
-        if not msg_info['active']:
+                pass
+            except discord.errors.HTTPException as e:
+                logging.error(f"Failed to delete the default message {state.default_message.id}: {e}")
+        if state.bot_messages:
+            # Some deletes failed and the messages are about to be forgotten, so fall back to clearing the channel
+            await delete_all_messages(channel, len(state.bot_messages))
+    else:
+        # Nothing posted yet, clear whatever a previous run left behind
+        await delete_all_messages(channel)
+    state.bot_messages = {}  # The old messages were just deleted, so they can't be edited anymore
+    state.default_message = None
+    state.shown_rows = None
+
+async def handle_messages(channel, rows, state):
+    # Only one coroutine at a time may touch the channel, so an update tick and /refresh can't interleave
+    async with state.lock:
+        bot_messages = state.bot_messages  # Dictionary to store active messages
+
+        # Nothing changed in any queue since the channel was last brought up to date, so there is nothing to send
+        if rows == state.shown_rows:
+            return
+        state.shown_rows = None  # Only set again once this tick's updates all went through
+
+        # If no active downloads and no embeds to show
+        if not rows:
+            # Delete all existing download messages
+            await delete_batches(channel, bot_messages, list(bot_messages))
+
+            # Display default message if it's not already displayed
+            if not state.default_message:  # Only create the default message if it doesn't exist
+                state.default_message = await channel.send("No active downloads currently.")
+            if not bot_messages:
+                state.shown_rows = rows
+            return
+
+        # If there are embeds (i.e., active downloads)
+        # Delete the default message if it's currently displayed
+        if state.default_message:
             try:
-                await msg_info['message'].delete()
-                del bot_messages[download_id]
+                await state.default_message.delete()
             except discord.errors.NotFound:
-                logging.warning(f"Message for download {download_id} not found when attempting to delete.")
+                logging.warning(f"Default message with ID {state.default_message.id} not found when attempting to delete.")
+            state.default_message = None  # Gone either way, so it's posted again once the queues are empty
+
+        # Batch downloads into groups of up to 10 embeds (Discord's limit), each batch is sent as one message
+        batched_rows = split_embeds(rows)
+        new_ids = {f'batch_{i}' for i in range(len(batched_rows))}  # Batches that are still needed after this tick
+        now = datetime.now(timezone.utc)  # Timestamp for every embed rebuilt in this tick
+
+        # Embeds currently shown for each download, so unchanged downloads reuse theirs even if they moved position
+        shown_embeds = {row: embed
+                        for msg_info in bot_messages.values()
+                        for row, embed in zip(msg_info['rows'], msg_info['embeds'])}
+
+        # Work out which batches need their message edited and which need a new message
+        edits = []
+        sends = []
+        failed = False  # Whether an edit failed, leaving its message out of date
+        for i, row_batch in enumerate(batched_rows):
+            batch_id = f'batch_{i}'  # Unique ID for each batch of embeds
+
+            if batch_id in bot_messages:
+                # Skip the edit if the message already shows exactly these downloads
+                if bot_messages[batch_id]['rows'] == row_batch:
+                    continue
+                # Only rebuild the embeds of downloads that changed since the last edit
+                embed_batch = [shown_embeds[row] if row in shown_embeds else build_embed(row, now) for row in row_batch]
+                edits.append((i, row_batch, embed_batch))
+            else:
+                embed_batch = [shown_embeds[row] if row in shown_embeds else build_embed(row, now) for row in row_batch]
+                sends.append((i, row_batch, embed_batch))
+
+        # Messages are independent resources, so the edits and the deletes of batches that are no longer needed
+        # are sent concurrently, discord.py waits out any rate limit they run into
+        results, _ = await asyncio.gather(
+            gather_limited(bot_messages[f'batch_{i}']['message'].edit(embeds=embed_batch)
+                           for i, _, embed_batch in edits),
+            delete_batches(channel, bot_messages, [batch_id for batch_id in bot_messages if batch_id not in new_ids])
+        )
+        for (i, row_batch, embed_batch), result in zip(edits, results):
+            batch_id = f'batch_{i}'
+            if isinstance(result, discord.errors.NotFound):
+                logging.warning(f"Message for batch {batch_id} not found. Creating a new one.")
+                sends.append((i, row_batch, embed_batch))
+            elif isinstance(result, BaseException):
+                logging.error(f"Failed to edit message for batch {batch_id}: {result}")  # Retried on the next tick
+                failed = True
+            else:
+                bot_messages[batch_id]['rows'] = row_batch
+                bot_messages[batch_id]['embeds'] = embed_batch
 
-    return None  # Return None as no default message is needed when there are active downloads
+        # New messages are sent one by one so they appear in the channel in batch order
+        for i, row_batch, embed_batch in sorted(sends, key=lambda send: send[0]):
+            new_msg = await channel.send(embeds=embed_batch)
+            bot_messages[f'batch_{i}'] = {'message': new_msg, 'rows': row_batch, 'embeds': embed_batch}
 
-async def handle_rate_limit(error):
-    """Handles rate limit errors by pausing execution for the specified retry_after time."""
-    if error.code == 429:  # 429 status code indicates a rate limit
-        retry_after = error.response.json().get('retry_after')
-        logging.warning(f"Rate limited. Retrying in {retry_after} seconds.")
-        await asyncio.sleep(retry_after)
-    else:
-        logging.error(f"Unexpected error occurred: {error}")
-        raise error
+        if not failed and len(bot_messages) == len(new_ids):
+            state.shown_rows = rows
+
+def collect_rows(results):
+    # Flatten the results of the concurrently gathered queries, logging any that failed
+    rows = []
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.error(f"An error occurred when querying an Arr instance: {result}")
+        else:
+            rows += result
+    return rows
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
@@ -340,6 +520,20 @@ RADARR_PORT_ANIME = os.getenv('RADARR_PORT_ANIME')
 RADARR_API_KEY_ANIME = os.getenv('RADARR_API_KEY_ANIME')
 RADARR_TITLE_ANIME = os.getenv('RADARR_TITLE_ANIME')
 
+# Every Arr instance to track, instances that aren't fully configured are skipped
+INSTANCES = [
+    make_query(kind, ip, port, api_key, title)
+    for kind, ip, port, api_key, title in (
+        ("sonarr", SONARR_IP, SONARR_PORT, SONARR_API_KEY, SONARR_TITLE),
+        ("sonarr", SONARR_IP_ANIME, SONARR_PORT_ANIME, SONARR_API_KEY_ANIME, SONARR_TITLE_ANIME),
+        ("radarr", RADARR_IP, RADARR_PORT, RADARR_API_KEY, RADARR_TITLE),
+        ("radarr", RADARR_IP_ANIME, RADARR_PORT_ANIME, RADARR_API_KEY_ANIME, RADARR_TITLE_ANIME),
+    )
+    if ip and port and api_key
+]
+
+CACHE_TTL = min(float(os.getenv('CACHE_TTL', 5)), 30)  # Default to 5 if not provided, capped at 30 seconds
+
 TIME_NUMERIC = int(os.getenv('TIME_NUMERIC', 15))  # Default to 15 if not provided
 TIME_FORMAT = os.getenv('TIME_FORMAT', 'seconds')  # Default to 'seconds' if not provided
 
@@ -353,43 +547,75 @@ elif TIME_FORMAT == 'hours':
 else:
     raise ValueError(f"Invalid TIME_FORMAT: {TIME_FORMAT}. Use 'seconds', 'minutes', or 'hours'.")
 
+# While every queue is empty the poll interval doubles each tick, up to IDLE_MAX_INTERVAL seconds
+POLL_INTERVAL = timedelta(**interval_kwargs).total_seconds()
+IDLE_MAX_INTERVAL = max(POLL_INTERVAL, float(os.getenv('IDLE_MAX_INTERVAL', 300)))  # Default to 300 if not provided
+
+def idle_interval(empty_streak):
+    return min(POLL_INTERVAL * 2 ** min(empty_streak, 10), IDLE_MAX_INTERVAL)
+
 handler = logging.StreamHandler(sys.stdout)  # Log to stdout
 handler.setLevel(logging.INFO)
 logging.basicConfig(level=logging.INFO, handlers=[handler], format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# Global variables to store the default message and bot messages
-default_message = None
-bot_messages = []  # Placeholder for the bot's messages
+# Global variables to store the bot's state and shared caches, the per-instance ones are keyed by the query endpoint
+state = BotState()
+http_session = None  # Shared aiohttp session used for all Sonarr & Radarr queries
+poster_cache = {}  # Poster URL for each (Arr instance endpoint, series/movie ID)
+last_hashes = {}  # Hash of the last queue payload received from each Arr instance
+last_rows = {}  # Download rows parsed from that payload, reused while the payload stays the same
+last_signatures = {}  # Displayed fields of every item in that payload, see queue_signature
+row_cache = {}  # Queue item ID -> (its displayed fields, DownloadRow) for each Arr instance
+last_validators = {}  # Conditional request headers built from the last queue response of each Arr instance
+cache_expiry = {}  # time.monotonic() until which each Arr instance's rows are served without a request
+
+async def fetch_all():
+    # Query every Sonarr & Radarr instance concurrently and combine their downloads
+    results = await asyncio.gather(
+        *(query_arr(http_session, query) for query in INSTANCES),
+        return_exceptions=True
+    )
+    return collect_rows(results)
+
+class TrackerBot(commands.Bot):
+    async def close(self):
+        # Close the shared HTTP session along with the Discord connection, so no sockets are left open on shutdown
+        if http_session is not None and not http_session.closed:
+            await http_session.close()
+        await super().close()
 
 # Discord Intents setup
 intents = discord.Intents.default()
 intents.message_content = True  # Enable message content intent
-client = commands.Bot(command_prefix='/', intents=intents)
+client = TrackerBot(command_prefix='/', intents=intents)
 
 @client.event
 async def on_ready():
-    global bot_messages, default_message
-    bot_messages = {}  # Ensure bot_messages is initialized as a dictionary
-    default_message = None  # Reset default_message
+    global http_session
+
+    # Create the shared HTTP session once, so connections to the Arr instances are reused between ticks
+    if http_session is None or http_session.closed:
+        # Keep idle connections alive for 75 seconds (nginx's default) so they survive the gap between polls,
+        # and cache DNS lookups of the Arr hosts for 5 minutes instead of aiohttp's default 10 seconds
+        connector = aiohttp.TCPConnector(limit=8, limit_per_host=4, keepalive_timeout=75, ttl_dns_cache=300)
+        http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10))
 
     print(f'{client.user} has connected to Discord!')
     channel = client.get_channel(DISCORD_CHANNEL_ID)
 
     if channel:
         # Delete all messages in the channel
-        await delete_all_messages(channel)
+        async with state.lock:
+            await reset_channel(channel, state)
 
-        # Fetch data from both Sonarr and Radarr instances
-        embeds = []
-        embeds += query_sonarr(SONARR_IP, SONARR_PORT, SONARR_API_KEY, SONARR_TITLE)
-        embeds += query_sonarr(SONARR_IP_ANIME, SONARR_PORT_ANIME, SONARR_API_KEY_ANIME, SONARR_TITLE_ANIME)
-        embeds += query_radarr(RADARR_IP, RADARR_PORT, RADARR_API_KEY, RADARR_TITLE)
-        embeds += query_radarr(RADARR_IP_ANIME, RADARR_PORT_ANIME, RADARR_API_KEY_ANIME, RADARR_TITLE_ANIME)
+        # Fetch data from both Sonarr and Radarr instances concurrently
+        rows = await fetch_all()
 
         # Handle messages and default message
-        default_message = await handle_messages(channel, embeds)
-        # Perform garbage collection
+        await handle_messages(channel, rows, state)
+        # Move everything allocated during startup into the permanent generation, so later collections skip it
         gc.collect()
+        gc.freeze()
         # Start the task to update the messages every x minutes
         update_messages.start()
     else:
@@ -398,30 +624,21 @@ async def on_ready():
 
 @tasks.loop(**interval_kwargs)  # Task to run based on environment variables TIME_NUMERIC and TIME_FORMAT
 async def update_messages():
-    global default_message
     channel = client.get_channel(DISCORD_CHANNEL_ID)
 
     if channel:
         try:
-            # Fetch data from Sonarr & Radarr
-            embeds = []
-            # Get Sonarr and Radarr data
-            sonarr_embeds = query_sonarr(SONARR_IP, SONARR_PORT, SONARR_API_KEY, SONARR_TITLE)
-            sonarr_anime_embeds = query_sonarr(SONARR_IP_ANIME, SONARR_PORT_ANIME, SONARR_API_KEY_ANIME, SONARR_TITLE_ANIME)
-            radarr_embeds = query_radarr(RADARR_IP, RADARR_PORT, RADARR_API_KEY, RADARR_TITLE)
-            radarr_anime_embeds = query_radarr(RADARR_IP_ANIME, RADARR_PORT_ANIME, RADARR_API_KEY_ANIME, RADARR_TITLE_ANIME)
-
-            # Combine data from both sources
-            embeds += sonarr_embeds
-            embeds += radarr_embeds
-            embeds += sonarr_anime_embeds
-            embeds += radarr_anime_embeds
+            # Fetch data from Sonarr & Radarr concurrently
+            rows = await fetch_all()
 
             # Update messages
-            default_message = await handle_messages(channel, embeds, default_message)
+            await handle_messages(channel, rows, state)
 
-            # Perform garbage collection
-            gc.collect()
+            # Back off while the queues are empty, and return to the configured interval once something shows up
+            new_streak = state.empty_streak + 1 if not rows else 0
+            if idle_interval(new_streak) != idle_interval(state.empty_streak):
+                update_messages.change_interval(seconds=idle_interval(new_streak))
+            state.empty_streak = new_streak
 
         except Exception as e:
             logging.error(f"An error occurred in update_messages: {e}")
@@ -430,28 +647,37 @@ async def update_messages():
 
 @client.tree.command(name="refresh", description="Refresh the current status of downloads")
 async def refresh(interaction: discord.Interaction):
-    global update_messages, default_message, bot_messages
-
     await interaction.response.send_message("Refreshing data...")
 
     if update_messages.is_running():
         update_messages.stop()
 
+    # Go back to the configured poll interval
+    state.empty_streak = 0
+    update_messages.change_interval(seconds=POLL_INTERVAL)
+
     channel = client.get_channel(DISCORD_CHANNEL_ID)
 
     if channel:
-        await delete_all_messages(channel)
+        async with state.lock:
+            await reset_channel(channel, state)
+        # Remove the "Refreshing data..." reply too, unless clearing the channel already took it
+        try:
+            await interaction.delete_original_response()
+        except discord.errors.NotFound:
+            pass
+        except discord.errors.HTTPException as e:
+            logging.error(f"Failed to delete the refresh reply: {e}")
 
-        embeds = []
-        embeds += query_sonarr(SONARR_IP, SONARR_PORT, SONARR_API_KEY, SONARR_TITLE)
-        embeds += query_sonarr(SONARR_IP_ANIME, SONARR_PORT_ANIME, SONARR_API_KEY_ANIME, SONARR_TITLE_ANIME)
-        embeds += query_radarr(RADARR_IP, RADARR_PORT, RADARR_API_KEY, RADARR_TITLE)
-        embeds += query_radarr(RADARR_IP_ANIME, RADARR_PORT_ANIME, RADARR_API_KEY_ANIME, RADARR_TITLE_ANIME)
+        cache_expiry.clear()  # A manual refresh always queries the Arr instances
+        rows = await fetch_all()
 
-        default_message = await handle_messages(channel, embeds)
+        await handle_messages(channel, rows, state)
         update_messages.start()
     else:
         print("Channel not found!")
 
 
+if uvloop:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 client.run(TOKEN, log_handler=None)